@@ -15,6 +15,7 @@ from tfpnp.trainer import MDDPGTrainer
 from tfpnp.trainer.mddpg.critic import ResNet_wobn
 from tfpnp.eval import Evaluator
 from tfpnp.utils.noise import GaussianModelD
+from tfpnp.utils.misc import compile_module, unwrap_module
 from tfpnp.utils.options import Options
 
 
@@ -32,6 +33,14 @@ def main(opt):
     denoiser = create_denoiser(opt).to(device)
     solver = create_solver_spi(opt, denoiser).to(device)
     num_var = solver.num_var
+
+    if opt.channels_last:
+        actor = actor.to(memory_format=torch.channels_last)
+        solver = solver.to(memory_format=torch.channels_last)
+
+    if opt.compile:
+        actor = compile_module(actor)
+        solver.denoiser = compile_module(solver.denoiser)
     
     # ---------------------------------------------------------------------------- #
     #                                     Valid                                    #
@@ -41,7 +50,7 @@ def main(opt):
     val_roots = [data_dir / 'spi' / 'SPISet13_2020' / f'x{K}' for K in Ks]
     val_datasets = [SPIEvalDataset(val_root, fns=None) for val_root in val_roots]
     
-    val_loaders = [torch.utils.data.DataLoader(val_dataset, batch_size=1, shuffle=False,
+    val_loaders = [torch.utils.data.DataLoader(val_dataset, batch_size=8, shuffle=False,
                                                num_workers=0, pin_memory=True) for val_dataset in val_datasets]
     val_names = [f'spi_x{K}' for K in Ks]
     val_loaders = dict(zip(val_names, val_loaders))
@@ -54,7 +63,7 @@ def main(opt):
     
     if opt.eval:
         actor_ckpt = torch.load(opt.resume)
-        actor.load_state_dict(actor_ckpt)
+        unwrap_module(actor).load_state_dict(actor_ckpt)
         evaluator.eval(actor, step=opt.resume_step)
         return
     
@@ -69,9 +78,11 @@ def main(opt):
     
     train_dataset = SPIDataset(train_root, fns=None, Ks=Ks)
     
+    # keep workers alive across epochs, these options are only valid with worker processes
+    worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 2} if opt.num_workers > 0 else {}
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=opt.env_batch, shuffle=True,
-        num_workers=opt.num_workers, pin_memory=True, drop_last=True)
+        num_workers=opt.num_workers, pin_memory=True, drop_last=True, **worker_kwargs)
 
     env = SPIEnv(train_loader, solver, max_episode_step=opt.max_episode_step, device=device)
 
@@ -84,6 +95,14 @@ def main(opt):
     critic = ResNet_wobn(base_dim+num_var, 18, 1).to(device)
     critic_target = ResNet_wobn(base_dim+num_var, 18, 1).to(device)
 
+    if opt.channels_last:
+        critic = critic.to(memory_format=torch.channels_last)
+        critic_target = critic_target.to(memory_format=torch.channels_last)
+
+    if opt.compile:
+        critic = compile_module(critic)
+        critic_target = compile_module(critic_target)
+
     trainer = MDDPGTrainer(opt, env, actor=actor,
                            critic=critic, critic_target=critic_target,
                            lr_scheduler=lr_scheduler, device=device,
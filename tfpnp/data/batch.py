@@ -335,6 +335,17 @@ class Batch:
             elif isinstance(v, Batch):
                 v.to_numpy()
 
+    def pin_memory(self) -> "Batch":
+        """Pin all torch.Tensor to page-locked memory in-place and return self.
+        It is also called by the DataLoader when ``pin_memory=True``.
+        """
+        for k, v in self.items():
+            if isinstance(v, torch.Tensor):
+                self.__dict__[k] = v.pin_memory()
+            elif isinstance(v, Batch):
+                v.pin_memory()
+        return self
+
     def to_torch(
         self,
         dtype: Optional[torch.dtype] = None,
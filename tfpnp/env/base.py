@@ -202,10 +202,18 @@ class PnPEnv(DifferentiableEnv):
 
     def get_images(self, ob, pre_process=torch2img255):
         input = pre_process(self._get_attribute(ob, 'input'))
+        output, gt = self.get_outputs(ob, pre_process)
+
+        return input, output, gt
+
+    def get_outputs(self, ob, pre_process=torch2img255):
+        """ Same as `get_images`, but skip the input image which never changes 
+            during an episode.
+        """
         output = pre_process(self._get_attribute(ob, 'output'))
         gt = pre_process(self._get_attribute(ob, 'gt'))
 
-        return input, output, gt
+        return output, gt
 
     ###################################################
     #   Private utils
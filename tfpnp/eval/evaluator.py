@@ -1,18 +1,21 @@
 import os
 import time
 import torch
+from torch.cuda.amp import autocast
 from os.path import join
 
 import numpy as np
 
 from ..utils.visualize import save_img, seq_plot
-from ..utils.metric import psnr_qrnn3d
-from ..utils.misc import MetricTracker, prRed
+from ..utils.metric import psnr_qrnn3d, torch_psnr_qrnn3d
+from ..utils.misc import MetricTracker, prRed, to_float, to_numpy, to_img255
 from ..env.base import PnPEnv
+from ..data.util import dict_to_device
 
 
 class Evaluator(object):
     def __init__(self, opt, env: PnPEnv, val_loaders, writer, device, savedir=None, metric=psnr_qrnn3d):
+        """ `metric(output, gt)` scores a single sample given two [C,H,W] numpy images in [0, 255]. """
         self.opt = opt
         self.env = env
         self.val_loaders = val_loaders
@@ -21,103 +24,154 @@ class Evaluator(object):
         self.savedir = savedir
         self.metric = metric
 
+        # the validation sets are small, load them to device once for all evaluations
+        self.val_batches = {name: [dict_to_device(data, device) for data in val_loader]
+                            for name, val_loader in val_loaders.items()}
+
     @torch.no_grad()
     def eval(self, policy, step):
         policy.eval()
-        for name, val_loader in self.val_loaders.items():
+        for name, val_batches in self.val_batches.items():
             metric_tracker = MetricTracker()
-            for index, data in enumerate(val_loader):
-                assert data['gt'].shape[0] == 1
-
-                # obtain sample's name
-                if name in data.keys():
-                    data_name = data['name'][0]
-                    data.pop('name')
+            index = 0
+            for data in val_batches:
+                # the env modifies its state in-place, so work on a copy of the cached batch
+                data = {k: v.clone() if torch.is_tensor(v) else v for k, v in data.items()}
+                B = data['gt'].shape[0]
+
+                # obtain samples' names
+                if 'name' in data.keys():
+                    data_names = list(data.pop('name'))
                 else:
-                    data_name = 'case' + str(index)
+                    data_names = ['case' + str(index + i) for i in range(B)]
+                index += B
 
                 # run
-                psnr_init, psnr_finished, info, imgs = eval_single(self.env, data, policy,
-                                                                   max_episode_step=self.opt.max_episode_step,
-                                                                   loop_penalty=self.opt.loop_penalty,
-                                                                   metric=self.metric)
+                psnr_init, psnr_finished, info, imgs = eval_batch(self.env, data, policy,
+                                                                  max_episode_step=self.opt.max_episode_step,
+                                                                  loop_penalty=self.opt.loop_penalty,
+                                                                  metric=batch_metric(self.metric),
+                                                                  amp=self.opt.amp)
 
-                episode_steps, episode_reward, psnr_seq, reward_seq, action_seqs, run_time = info
+                episode_steps, episode_reward, psnr_seqs, reward_seqs, action_seqs, run_time = info
                 input, output_init, output, gt = imgs
 
                 # save metric
-                metric_tracker.update({'iters': episode_steps, 'acc_reward': episode_reward,
-                                       'psnr_init': psnr_init, 'psnr': psnr_finished, 'time': run_time})
+                metric_tracker.update_batch({'iters': episode_steps, 'acc_reward': episode_reward,
+                                             'psnr_init': psnr_init, 'psnr': psnr_finished,
+                                             'time': np.full(B, run_time)})
 
                 # save imgs
                 if self.savedir is not None:
-                    base_dir = join(self.savedir, name, data_name, str(step))
-                    os.makedirs(base_dir, exist_ok=True)
+                    output, gt = to_numpy(output), to_numpy(gt)
+                    for i, data_name in enumerate(data_names):
+                        base_dir = join(self.savedir, name, data_name, str(step))
+                        os.makedirs(base_dir, exist_ok=True)
 
-                    # save_img(input, join(base_dir, 'input.png'))
-                    # save_img(output_init, join(base_dir, 'output_init.png'))
-                    save_img(output, join(base_dir, f'output_{psnr_finished: .2f}.png'))
-                    save_img(gt, join(base_dir, 'gt.png'))
+                        # save_img(input[i], join(base_dir, 'input.png'))
+                        # save_img(output_init[i], join(base_dir, 'output_init.png'))
+                        save_img(output[i], join(base_dir, f'output_{psnr_finished[i]: .2f}.png'))
+                        save_img(gt[i], join(base_dir, 'gt.png'))
 
-                    for k, v in action_seqs.items():
-                        seq_plot(v[0], 'step', k, save_path=join(base_dir, k+'.png'))
+                        for k, v in action_seqs.items():
+                            seq_plot(v[0, i], 'step', k, save_path=join(base_dir, k+'.png'))
 
-                    seq_plot(psnr_seq, 'step', 'psnr',
-                             save_path=join(base_dir, 'psnr.png'))
-                    seq_plot(reward_seq, 'step', 'reward',
-                             save_path=join(base_dir, 'reward.png'))
+                        seq_plot(psnr_seqs[i], 'step', 'psnr',
+                                 save_path=join(base_dir, 'psnr.png'))
+                        seq_plot(reward_seqs[i], 'step', 'reward',
+                                 save_path=join(base_dir, 'reward.png'))
 
             prRed('Step_{:07d}: {} | {}'.format(step - 1, name, metric_tracker))
 
 
-def eval_single(env, data, policy, max_episode_step, loop_penalty, metric):
+def batch_metric(metric):
+    """ Lift a per-sample numpy metric to batched device tensors, [B,C,H,W] x 2 -> [B].
+
+        psnr_qrnn3d has a tensor counterpart and is computed on device, other metrics 
+        fall back to a per-sample evaluation on host.
+    """
+    if metric is psnr_qrnn3d:
+        return torch_psnr_qrnn3d
+
+    def _metric(output, gt):
+        values = [metric(o, g) for o, g in zip(to_numpy(output), to_numpy(gt))]
+        return torch.tensor(values, dtype=torch.float64, device=output.device)
+    return _metric
+
+
+def eval_batch(env, data, policy, max_episode_step, loop_penalty, metric, amp=False):
+    """ Run a batch of validation samples through the env simultaneously.
+
+        Samples that stop early are dropped from `env.idx_left`, so the policy and 
+        the solver only process the samples that are still active at each step.
+        Images and metrics stay on device until the episode ends, so `metric` 
+        takes two [B,C,H,W] tensors and returns a [B] tensor, see `batch_metric`.
+    """
     observation = env.reset(data=data)
-    hidden = policy.init_state(observation.shape[0])  #TODO: add RNN support
-    _, output_init, gt = env.get_images(observation)    
-    
-    psnr_init = metric(output_init[0], gt[0])
+    B = observation.shape[0]
+    hidden = hidden_full = policy.init_state(B).to(env.device)  #TODO: add RNN support
+    input, output_init, gt = env.get_images(observation, pre_process=to_img255)
 
-    episode_steps = 0
-    episode_reward = np.zeros(1)
+    psnr_init = metric(output_init, gt)
+    output = output_init.clone()
 
-    psnr_seq = [psnr_init]
-    reward_seq = [0]
+    episode_steps = torch.zeros(B, dtype=torch.long, device=env.device)
+    rewards = torch.zeros(max_episode_step, B, device=env.device)
+    psnrs = torch.zeros(max_episode_step, B, dtype=psnr_init.dtype, device=env.device)
     action_seqs = {}
 
     ob = observation
     time_stamp = time.time()
-    while episode_steps < max_episode_step:
-        action, _, _, hidden = policy(env.get_policy_ob(ob), idx_stop=None, train=False, hidden=hidden)
-                
-        # since batch size = 1, ob and ob_masked are always identicial
-        ob, _, reward, done, _ = env.step(action)
+    for t in range(max_episode_step):
+        idx_left = env.idx_left
+        with autocast(enabled=amp):
+            action, _, _, hidden = policy(env.get_policy_ob(ob), idx_stop=None, train=False, hidden=hidden)
+        action = to_float(action)
+
+        # ob_active holds the samples processed in this step, ob only the ones left
+        ob_active, ob, reward, done, info = env.step(action)
+        hidden = hidden_full[env.idx_left, ...]
+
+        # reward covers the whole batch, penalize the active samples which continue looping
+        reward = reward[idx_left] - loop_penalty * (1 - info['done'].float()).unsqueeze(1)
+        rewards[t, idx_left] = reward[:, 0].detach()
+        episode_steps[idx_left] += 1
+
+        output_active, gt_active = env.get_outputs(ob_active, pre_process=to_img255)
+        output[idx_left] = output_active
+        psnrs[t, idx_left] = metric(output_active, gt_active)
+
+        # record actions on device, they are transferred once the episode ends
+        action.pop('idx_stop')
+        if t == 0:
+            action_seqs = {k: torch.zeros((max_episode_step,) + v.shape, dtype=v.dtype, device=v.device)
+                           for k, v in action.items()}
+        for k, v in action.items():
+            action_seqs[k][t, idx_left] = v.detach()
 
-        if not done:
-            reward = reward - loop_penalty
+        if done:
+            break
 
-        episode_reward += reward.item()
-        episode_steps += 1
+    if env.device.type == 'cuda':
+        torch.cuda.synchronize(env.device)
+    # amortized running time per sample
+    run_time = (time.time() - time_stamp) / B
 
-        _, output, gt = env.get_images(ob)
-        cur_psnr = metric(output[0], gt[0])
-        psnr_seq.append(cur_psnr.item())
-        reward_seq.append(reward.item())
+    # the samples are active in consecutive steps from the beginning
+    episode_steps = episode_steps.cpu().numpy()
+    rewards = rewards[:t+1].cpu().numpy()
+    psnrs = psnrs[:t+1].cpu().numpy()
+    psnr_init = psnr_init.cpu().numpy()
 
-        action.pop('idx_stop')
-        for k, v in action.items():            
-            if k not in action_seqs.keys():
-                action_seqs[k] = []
-            for i in range(v.shape[0]):
-                action_seqs[k].append(list(v[i].detach().cpu().numpy()))
+    episode_reward = rewards.sum(axis=0)
+    psnr_finished = psnrs[episode_steps - 1, np.arange(B)]
+    reward_seqs = [[0] + rewards[:episode_steps[i], i].tolist() for i in range(B)]
+    psnr_seqs = [[psnr_init[i]] + psnrs[:episode_steps[i], i].tolist() for i in range(B)]
 
-        if done:
-            break
-        
-    run_time = time.time() - time_stamp
-    input, output, gt = env.get_images(ob)
-    psnr_finished = metric(output[0], gt[0])
+    # action_seqs[k]: [steps, B, action_bundle]
+    action_seqs = {k: v[:t+1].cpu().numpy() for k, v in action_seqs.items()}
 
-    info = (episode_steps, episode_reward, psnr_seq, reward_seq, action_seqs, run_time)
-    imgs = (input[0], output_init[0], output[0], gt[0])
+    info = (episode_steps, episode_reward, psnr_seqs, reward_seqs, action_seqs, run_time)
+    imgs = (input, output_init, output, gt)
 
     return psnr_init, psnr_finished, info, imgs
@@ -2,13 +2,16 @@ import torch
 import torch.nn as nn
 import numpy as np
 from torch.optim.adam import Adam
+from torch.cuda.amp import autocast, GradScaler
 from tensorboardX.writer import SummaryWriter
 import time
+import queue
+import threading
 
 from ...data.batch import Batch
 from ...eval import Evaluator
 from ...env import PnPEnv
-from ...utils.misc import DataParallel, soft_update, hard_update
+from ...utils.misc import DataParallel, soft_update, hard_update, unwrap_module, to_float
 from ...utils.rpm import ReplayMemory
 from ...utils.log import Logger, COLOR
 from ...policy.sync_batchnorm import DataParallelWithCallback
@@ -30,6 +33,7 @@ class MDDPGTrainer:
         self.writer = writer
         self.device = device
         self.logger = Logger() if logger is None else logger
+        self._last_eval_step = -1
 
         #TODO: estimate actual needed memory to prevent OOM error.
         self.buffer = ReplayMemory(opt.rmsize * opt.max_episode_step) if buffer is None else buffer
@@ -39,6 +43,20 @@ class MDDPGTrainer:
 
         self.criterion = nn.MSELoss()   # criterion for value loss
 
+        # mixed precision for actor/critic, both are no-ops if opt.amp is disabled
+        self.scaler_actor = GradScaler(enabled=opt.amp)
+        self.scaler_critic = GradScaler(enabled=opt.amp)
+
+        # replay buffer insertions are performed by a background thread
+        self._store_q = queue.Queue(maxsize=4)
+        self._store_error = None
+        threading.Thread(target=self._store_worker, daemon=True).start()
+
+        # pinned staging buffers of save_experience. At most maxsize queued + 1 in-process 
+        # experiences are pending, so a slot is free again when its turn comes.
+        self._staging = [{} for _ in range(self._store_q.maxsize + 2)]
+        self._staging_index = 0
+
         hard_update(self.critic_target, self.critic)
         
         self.choose_device()
@@ -47,8 +65,17 @@ class MDDPGTrainer:
         # get initial observation
         ob = self.env.reset()
 
-        hidden = hidden_full = self.actor.init_state(ob.shape[0]).to(self.device)  #TODO: add RNN support
+        # the batch size is fixed (drop_last), so the initial hidden state is built once 
+        # and shared by all episodes. It is never modified in-place.
+        hidden_init = self.actor.init_state(ob.shape[0]).to(self.device)  #TODO: add RNN support
+        hidden = hidden_full = hidden_init
         episode, episode_step = 0, 0
+
+        # warm up compiled networks to keep the compilation cost out of the training loop
+        if self.opt.compile:
+            for _ in range(3):
+                self.run_policy(self.env.get_policy_ob(ob), hidden)
+
         time_stamp = time.time()
 
         for step in range(1, self.opt.train_steps+1):
@@ -70,7 +97,7 @@ class MDDPGTrainer:
                 
                 if step > self.opt.warmup:
                     if self.evaluator is not None and (episode+1) % self.opt.validate_interval == 0:
-                        self.evaluator.eval(self.actor, step)
+                        self.evaluate(step)
                         self.save_model(self.opt.output)
 
                 train_time_interval = time.time() - time_stamp
@@ -93,21 +120,35 @@ class MDDPGTrainer:
 
                 # reset state for next episode
                 ob = self.env.reset()
-                hidden = hidden_full = self.actor.init_state(ob.shape[0]).to(self.device)
+                hidden = hidden_full = hidden_init
                 episode += 1
                 episode_step = 0
                 time_stamp = time.time()
 
             # save model
             if step % self.opt.save_freq == 0 or step == self.opt.train_steps:
-                self.evaluator.eval(self.actor, step)
+                self.evaluate(step)
                 self.logger.log('Saving model at Step_{:07d}...'.format(step), color=COLOR.RED)
                 self.save_model(self.opt.output, step)
 
+    def evaluate(self, step):
+        # validation and checkpointing may coincide, evaluate at most once per step
+        if self.evaluator is None or step == self._last_eval_step:
+            return
+        self.evaluator.eval(self.actor, step)
+        self._last_eval_step = step
+
     def _update_policy(self, episode_train_times, env_batch, step):
         self.actor.train()
-
-        tot_Q, tot_value_loss, tot_dist_entropy = 0, 0, 0
+        # make sure all the pending experiences are in the replay buffer
+        self._check_store_error()
+        self._store_q.join()
+        self._check_store_error()
+
+        # accumulate on device to avoid a host sync per gradient step
+        tot_Q = torch.zeros((), device=self.device)
+        tot_value_loss = torch.zeros((), device=self.device)
+        tot_dist_entropy = torch.zeros((), device=self.device)
         lr = self.lr_scheduler(step)
 
         for _ in range(episode_train_times):
@@ -118,9 +159,9 @@ class MDDPGTrainer:
             tot_value_loss += value_loss
             tot_dist_entropy += dist_entropy
 
-        mean_Q = tot_Q / episode_train_times
-        mean_dist_entropy = tot_dist_entropy / episode_train_times
-        mean_value_loss = tot_value_loss / episode_train_times
+        # materialize python scalars once for logging
+        mean_Q, mean_dist_entropy, mean_value_loss = (
+            torch.stack([tot_Q, tot_dist_entropy, tot_value_loss]) / episode_train_times).tolist()
 
         tensorboard_result = {'critic_lr': lr['critic'], 'actor_lr': lr['actor'],
                               'Q': mean_Q, 'dist_entropy': mean_dist_entropy, 'critic_loss': mean_value_loss}
@@ -141,7 +182,10 @@ class MDDPGTrainer:
 
         policy_ob = self.env.get_policy_ob(ob)
 
-        action, action_log_prob, dist_entropy, _ = self.actor(policy_ob, None, True, hidden)
+        with autocast(enabled=self.opt.amp):
+            action, action_log_prob, dist_entropy, _ = self.actor(policy_ob, None, True, hidden)
+        # the solver always runs in full precision
+        action = to_float(action)
 
         ob2, reward = self.env.forward(ob, action)
         reward -= self.opt.loop_penalty
@@ -149,10 +193,18 @@ class MDDPGTrainer:
         eval_ob = self.env.get_eval_ob(ob)
         eval_ob2 = self.env.get_eval_ob(ob2)
 
+        # evaluate both states in a single critic forward, 
+        # which is fine since the critic has no batch-dependent layers
+        B = eval_ob.shape[0]
+        with autocast(enabled=self.opt.amp):
+            V_all = self.critic(torch.cat([eval_ob, eval_ob2], dim=0))
+        V_cur, V_next = torch.split(V_all.float(), [B, B], dim=0)
+
         # compute actor critic loss for discrete action
-        V_cur = self.critic(eval_ob)
         with torch.no_grad():
-            V_next_target = self.critic_target(eval_ob2)
+            with autocast(enabled=self.opt.amp):
+                V_next_target = self.critic_target(eval_ob2)
+            V_next_target = V_next_target.float()
             V_next_target = (
                 self.opt.discount * (1 - action['idx_stop'].float())).unsqueeze(-1) * V_next_target
             Q_target = V_next_target + reward
@@ -160,7 +212,6 @@ class MDDPGTrainer:
         a2c_loss = action_log_prob * advantage
 
         # compute ddpg loss for continuous actions
-        V_next = self.critic(eval_ob2)
         V_next = (self.opt.discount * (1 - action['idx_stop'].float())).unsqueeze(-1) * V_next
         ddpg_loss = V_next + reward
 
@@ -170,45 +221,100 @@ class MDDPGTrainer:
         policy_loss = - (a2c_loss + ddpg_loss + self.opt.lambda_e * entroy_regularization).mean()
         value_loss = self.criterion(Q_target, V_cur)
 
-        # perform one step gradient descent
-        self.actor.zero_grad()
-        policy_loss.backward(retain_graph=True)
-        self.optimizer_actor.step()
-
-        self.critic.zero_grad()
-        value_loss.backward(retain_graph=True)
-        self.optimizer_critic.step()
+        # perform one step gradient descent. 
+        # both gradients are computed before any update, and each loss only reaches 
+        # the parameters of its own network, i.e., ddpg loss never updates the critic.
+        actor_params = list(self.actor.parameters())
+        critic_params = list(self.critic.parameters())
+        # the graph of the shared critic forward is still needed by the value loss
+        actor_grads = torch.autograd.grad(self.scaler_actor.scale(policy_loss), actor_params,
+                                          retain_graph=True, allow_unused=True)
+        critic_grads = torch.autograd.grad(self.scaler_critic.scale(value_loss), critic_params,
+                                           allow_unused=True)
+
+        for param, grad in zip(actor_params, actor_grads):
+            param.grad = grad
+        for param, grad in zip(critic_params, critic_grads):
+            param.grad = grad
+
+        # the scalers unscale the gradients and skip the step on inf/nan
+        self.scaler_actor.step(self.optimizer_actor)
+        self.scaler_critic.step(self.optimizer_critic)
+        self.scaler_actor.update()
+        self.scaler_critic.update()
+        # release the gradients instead of keeping them around until the next update
+        self.optimizer_actor.zero_grad(set_to_none=True)
+        self.optimizer_critic.zero_grad(set_to_none=True)
 
         # soft update target network
         soft_update(self.critic_target, self.critic, self.opt.tau)
 
-        return -policy_loss.item(), value_loss.item(), entroy_regularization.mean().item()
+        return -policy_loss.detach(), value_loss.detach(), entroy_regularization.mean().detach()
 
     def run_policy(self, ob, hidden=None):
         self.actor.eval()
-        with torch.no_grad():
+        with torch.no_grad(), autocast(enabled=self.opt.amp):
             action, _, _, hidden = self.actor(ob, None, True, hidden)
             # action, _, _, hidden = self.actor(state=ob, idx_stop=None, train=True, hidden=hidden)
+        action = to_float(action)
         self.actor.train()
         return action, hidden
 
     def save_experience(self, ob, hidden):
+        self._check_store_error()
+
+        # issue all the D2H copies asynchronously, the background thread waits 
+        # for them before storing the experience into the replay buffer
+        staging = self._staging[self._staging_index]
+        self._staging_index = (self._staging_index + 1) % len(self._staging)
+
         for k, v in ob.items():
             if isinstance(v, torch.Tensor):
-                ob[k] = ob[k].clone().detach().cpu()
-
-        hidden = hidden.clone().detach().cpu()
-        ob['hidden'] = hidden
-        
-        B = ob.shape[0]
-        for i in range(B):
-            self.buffer.store(ob[i])
+                ob[k] = self._to_cpu(v, staging, k)
+
+        ob['hidden'] = self._to_cpu(hidden, staging, 'hidden')
+
+        event = None
+        if self.device.type == 'cuda':
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(self.device))
+        self._store_q.put((ob, event))
+
+    def _store_worker(self):
+        while True:
+            ob, event = self._store_q.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                self.buffer.store_batch(ob)
+            except Exception as e:
+                # keep consuming the queue so the main thread never blocks, 
+                # the error is re-raised there
+                self._store_error = e
+            finally:
+                self._store_q.task_done()
+
+    def _check_store_error(self):
+        if self._store_error is not None:
+            raise RuntimeError('failed to store experience into the replay buffer') from self._store_error
+
+    def _to_cpu(self, tensor, staging, key):
+        if self.device.type != 'cuda':
+            return tensor.clone().detach().cpu()
+        # reuse the staging buffer, only the number of active samples varies
+        B = tensor.shape[0]
+        if key not in staging or staging[key].shape[0] < B:
+            staging[key] = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        return staging[key][:B].copy_(tensor.detach(), non_blocking=True)
 
     def convert2batch(self, obs):
-        batch = Batch.stack(obs)
+        # ReplayMemory returns stacked samples, other buffers may return a list of samples
+        batch = obs if isinstance(obs, Batch) else Batch.stack(obs)
+        if self.device.type == 'cuda':
+            batch.pin_memory()
         for k, v in batch.items():
             if isinstance(v, torch.Tensor):
-                batch[k] = batch[k].to(self.device)
+                batch[k] = v.to(self.device, non_blocking=True)
         return batch
 
     def save_model(self, path, step=None):
@@ -218,25 +324,27 @@ class MDDPGTrainer:
             self.critic_target = self.critic_target.module      
 
         self.actor.cpu()
-        self.critic.cpu()                    
+        self.critic.cpu()
+        actor, critic = unwrap_module(self.actor), unwrap_module(self.critic)
         if step is None:
-            torch.save(self.actor.state_dict(), '{}/actor.pkl'.format(path))
-            torch.save(self.critic.state_dict(), '{}/critic.pkl'.format(path))
+            torch.save(actor.state_dict(), '{}/actor.pkl'.format(path))
+            torch.save(critic.state_dict(), '{}/critic.pkl'.format(path))
         else:
-            torch.save(self.actor.state_dict(),
+            torch.save(actor.state_dict(),
                        '{}/actor_{:07d}.pkl'.format(path, step))
-            torch.save(self.critic.state_dict(),
+            torch.save(critic.state_dict(),
                        '{}/critic_{:07d}.pkl'.format(path, step))
         
         self.choose_device()
 
     def load_model(self, path, step=None):
+        actor, critic = unwrap_module(self.actor), unwrap_module(self.critic)
         if step is None:
-            self.actor.load_state_dict(torch.load('{}/actor.pkl'.format(path)))
-            self.critic.load_state_dict(torch.load('{}/critic.pkl'.format(path)))
+            actor.load_state_dict(torch.load('{}/actor.pkl'.format(path)))
+            critic.load_state_dict(torch.load('{}/critic.pkl'.format(path)))
         else:
-            self.actor.load_state_dict(torch.load('{}/actor_{:07d}.pkl'.format(path, step)))
-            self.critic.load_state_dict(torch.load('{}/critic_{:07d}.pkl'.format(path, step)))
+            actor.load_state_dict(torch.load('{}/actor_{:07d}.pkl'.format(path, step)))
+            critic.load_state_dict(torch.load('{}/critic_{:07d}.pkl'.format(path, step)))
 
     def choose_device(self):
         self.actor.to(self.device)
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from skimage.metrics import peak_signal_noise_ratio, structural_similarity
 from functools import partial
 
@@ -21,10 +22,18 @@ def MSIQA(X, Y):
 
 
 def psnr_qrnn3d(X, Y, data_range=255):
+    if torch.is_tensor(X):
+        return torch_psnr_qrnn3d(X, Y, data_range)
     cal_bwpsnr = Bandwise(partial(peak_signal_noise_ratio, data_range=data_range))
     return np.mean(cal_bwpsnr(X, Y))
 
 
+def torch_psnr_qrnn3d(X, Y, data_range=255):
+    # X, Y: [..., C, H, W], computed on their device in float64 like skimage
+    mse = torch.mean((X.double() - Y.double()) ** 2, dim=(-2, -1))
+    return torch.mean(10 * torch.log10(data_range ** 2 / mse), dim=-1)
+
+
 def ssim_qrnn3d(X, Y):
     X = X.transpose(2, 0, 1)
     Y = Y.transpose(2, 0, 1)
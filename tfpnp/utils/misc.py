@@ -1,5 +1,6 @@
 import os
 import torch
+from collections import defaultdict
 import torch.nn.functional as F
 import numpy as np
 
@@ -11,6 +12,11 @@ def torch2img255(img):
     img = (np.clip(img, 0, 1) * 255)
     return img
 
+
+def to_img255(img):
+    # same as torch2img255, but keep the tensor on its device
+    return torch.clamp(img, 0, 1) * 255
+
 # https://github.com/pytorch/pytorch/issues/16885
 
 
@@ -24,19 +30,23 @@ class DataParallel(torch.nn.DataParallel):
 
 class MetricTracker(object):
     def __init__(self, dic=None, total_num=None):
-        self.dic = dic or {}
-        self.total_num = total_num or {}
+        self.dic = defaultdict(int, dic or {})
+        self.total_num = defaultdict(int, total_num or {})
 
     def update(self, new_dic):
         for key in new_dic:
-            if not key in self.dic:
-                self.dic[key] = new_dic[key]
-                self.total_num[key] = 1
-            else:
-                self.dic[key] += new_dic[key]
-                self.total_num[key] += 1
+            self.dic[key] += new_dic[key]
+            self.total_num[key] += 1
         # self.total_num += 1
 
+    def update_batch(self, new_dic):
+        # each value is a 1-D tensor/array of per-sample metrics, 
+        # which is summed on its own device.
+        for key in new_dic:
+            value = new_dic[key]
+            self.dic[key] += value.sum()
+            self.total_num[key] += len(value)
+
     def __getitem__(self, key):
         return self.dic[key] / self.total_num[key]
 
@@ -44,7 +54,7 @@ class MetricTracker(object):
         keys = sorted(self.keys())
         res = ''
         for key in keys:
-            res += (key + ': %.2f' % self[key] + ' | ')
+            res += (key + ': %.2f' % float(self[key]) + ' | ')
         return res
 
     def keys(self):
@@ -78,11 +88,21 @@ def to_tensor(ndarray, device, dtype=torch.float):
     return torch.tensor(ndarray, dtype=dtype, device=device)
 
 
+def to_float(dic):
+    """ Cast the floating point tensors of a dict (e.g., an action computed under autocast) to float32. """
+    return {k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v for k, v in dic.items()}
+
+
 def soft_update(target, source, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(
-            target_param.data * (1.0 - tau) + param.data * tau
-        )
+    target_params = [param.data for param in target.parameters()]
+    source_params = [param.data for param in source.parameters()]
+    if hasattr(torch, '_foreach_mul_'):
+        # multi-tensor kernels instead of a few kernels per parameter
+        torch._foreach_mul_(target_params, 1.0 - tau)
+        torch._foreach_add_(target_params, source_params, alpha=tau)
+    else:
+        for target_param, param in zip(target_params, source_params):
+            target_param.mul_(1.0 - tau).add_(param, alpha=tau)
 
 
 def hard_update(target, source):
@@ -92,6 +112,24 @@ def hard_update(target, source):
         target_param.data.copy_(param.data)
 
 
+def compile_module(module, mode='reduce-overhead'):
+    """ Compile a module with `torch.compile` (PyTorch >= 2.0), or return it untouched
+        if the installed PyTorch does not support it.
+    """
+    if not hasattr(torch, 'compile'):
+        prRed('[!] torch.compile is not available, fallback to eager mode')
+        return module
+
+    # survive graph breaks instead of raising
+    torch._dynamo.config.suppress_errors = True
+    return torch.compile(module, mode=mode, dynamic=False)
+
+
+def unwrap_module(module):
+    """ Return the original module wrapped by `torch.compile`. """
+    return getattr(module, '_orig_mod', module)
+
+
 def get_output_folder(parent_dir, env_name):
     """Return save folder.
 
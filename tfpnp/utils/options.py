@@ -33,6 +33,9 @@ class Options:
         self.parser.add_argument('--lambda_e', '-le', type=float, default=0.05, help='penalty of loop')
         self.parser.add_argument('--denoiser', type=str, default='unet', help='denoising network')
         self.parser.add_argument('--solver', type=str, default='admm', help='invoked solver')
+        self.parser.add_argument('--amp', action='store_true', help='use mixed precision for policy/critic networks')
+        self.parser.add_argument('--channels_last', action='store_true', help='use channels_last memory format for networks')
+        self.parser.add_argument('--compile', action='store_true', help='compile networks with torch.compile (PyTorch >= 2.0)')
         self.parser.add_argument('--debug', dest='debug', action='store_true', help='print some info')
 
         self.initialized = True
@@ -1,39 +1,65 @@
 import random
+import torch
+
+from ..data.batch import Batch
 
 
 class ReplayMemory:
+    """ Replay memory storing each field of the observations in its own 
+        (page-locked if CUDA is available) tensor of shape [capacity, ...].
+    """
     def __init__(self, capacity):
         self.capacity = capacity
-        self.buffer = []
+        self.buffer = None  # allocated on the first store
         self.index = 0
+        self._size = 0
+        self.pin_memory = torch.cuda.is_available()
+
+    def _alloc(self, obj):
+        self.buffer = Batch({k: torch.empty((self.capacity,) + tuple(v.shape), dtype=v.dtype,
+                                            pin_memory=self.pin_memory)
+                             for k, v in obj.items()})
 
     def store(self, obj):
-        if self.size() > self.capacity:
-            print('buffer size larger than capacity, trimming...')
-            self.buffer = self.buffer[(self.size() - self.capacity):]
-        elif self.size() == self.capacity:
-            self.buffer[self.index] = obj
-            self.index += 1
-            self.index %= self.capacity
-        else:
-            self.buffer.append(obj)
+        if self.buffer is None:
+            self._alloc(obj)
+        for k, v in obj.items():
+            self.buffer[k][self.index] = v
+        self.index = (self.index + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def store_batch(self, batch):
+        B = batch.shape[0]
+        if self.buffer is None:
+            self._alloc(batch[0])
+        index = (self.index + torch.arange(B)) % self.capacity
+        for k, v in batch.items():
+            self.buffer[k][index] = v
+        self.index = (self.index + B) % self.capacity
+        self._size = min(self._size + B, self.capacity)
 
     def size(self):
-        return len(self.buffer)
+        return self._size
 
     def sample_batch(self, env_batch):
-        if self.size() < env_batch:
-            index_value = random.sample(
-                list(enumerate(self.buffer)), self.size())
+        """ Return a Batch of `env_batch` random samples, already stacked (and pinned). """
+        index = random.sample(range(self.size()), min(self.size(), env_batch))
+        index = torch.tensor(index, dtype=torch.long)
+        batch = Batch()
+        for k, v in self.buffer.items():
+            out = torch.empty((len(index),) + v.shape[1:], dtype=v.dtype, pin_memory=self.pin_memory)
+            batch[k] = torch.index_select(v, 0, index, out=out)
+        return batch
+
+
+def _clone_row(batch, i):
+    row = Batch()
+    for k, v in batch.items():
+        if isinstance(v, Batch):
+            row[k] = _clone_row(v, i)
         else:
-            index_value = random.sample(
-                list(enumerate(self.buffer)), env_batch)
-        indexes = []
-        values = []
-        for idx, val in index_value:
-            indexes.append(idx)
-            values.append(val)
-        return values
+            row[k] = v[i].clone() if torch.is_tensor(v) else v[i].copy()
+    return row
 
 
 class GroupReplayMemory:
@@ -61,6 +87,12 @@ class GroupReplayMemory:
         else:
             self.buffer[key].append(obj)
 
+    def store_batch(self, batch):
+        # the caller may reuse the batch, so store copies instead of views.
+        # clone the rows only, deepcopy of a view would copy the whole storage
+        for i in range(batch.shape[0]):
+            self.store(_clone_row(batch, i))
+
     def _size(self, key):
         return len(self.buffer[key])
     